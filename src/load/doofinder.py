@@ -10,23 +10,283 @@ Usage:
                                  --hash-id YOUR_DOOFINDER_HASH_ID \
                                  --index-name YOUR_INDEX_NAME \
                                  --products-file path/to/products.json \
-                                 --output-file doofinder_upload_status.json
+                                 --output-file doofinder_upload_status.json \
+                                 --workers 5 \
+                                 --batch-size 100 \
+                                 --max-batch-bytes 5242880 \
+                                 --auto-tune \
+                                 --replace \
+                                 --compress \
+                                 --http2
 """
 
 import argparse
 import asyncio
-from typing import Any, Dict, List
+import gzip
+import statistics
+import time
+from contextlib import aclosing, asynccontextmanager
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import uuid4
 
-import pydoof
+import aiofiles
+import aiohttp
+import httpx
+import ijson
+import orjson
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential,
+)
 from tqdm import tqdm
 
+from src.logger import get_logger
 from src.utils import load_json, save_json
 
+logger = get_logger(__name__)
 
-def transform_product(product: Dict[str, Any]) -> Dict[str, Any]:
+RETRY_STATUSES = {429, 502, 503, 504}
+TRANSPORT_ERRORS = (aiohttp.ClientError, httpx.TransportError, asyncio.TimeoutError)
+COMPRESS_MIN_BYTES = 16 * 1024
+MAX_RETRY_AFTER = 60
+
+# AIMD concurrency control: halve on >5% 429s, double after a clean minute
+THROTTLE_WINDOW = 20
+THROTTLE_RATE = 0.05
+RECOVERY_SECONDS = 60
+
+TUNE_FILE = Path.home() / ".doofinder_tune.json"
+TUNE_GRID = [(4, 50), (8, 100), (16, 200), (16, 500)]
+# Enough products for every grid point to keep all its workers busy
+TUNE_SAMPLE_SIZE = max(workers * batch_size for workers, batch_size in TUNE_GRID)
+TUNE_SECONDS = 3
+
+
+class DoofinderAPIError(Exception):
+    """Error response from the Doofinder Management API"""
+
+    def __init__(self, status: int, message: str, headers=None):
+        super().__init__(f"{status}, message='{message}'")
+        self.status = status
+        self.headers = headers
+
+
+def is_transient_error(exc: BaseException) -> bool:
+    """Whether a failed request is worth retrying"""
+    if isinstance(exc, DoofinderAPIError):
+        return exc.status in RETRY_STATUSES
+    return isinstance(exc, TRANSPORT_ERRORS)
+
+
+def wait_retry_after(retry_state) -> float:
+    """Honour the Retry-After header on 429s, back off exponentially otherwise"""
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, DoofinderAPIError) and exc.status == 429:
+        retry_after = (exc.headers or {}).get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), MAX_RETRY_AFTER)
+    return wait_exponential(multiplier=0.5, max=30)(retry_state)
+
+
+class DoofinderIngestion:
+    """Doofinder Management API client sharing one keep-alive HTTP session"""
+
+    def __init__(
+        self,
+        token: str,
+        management_url: str,
+        hash_id: str,
+        index_name: str,
+        workers: int = 5,
+        batch_size: int = 100,
+        max_batch_bytes: int = 5 * 1024 * 1024,
+        temp: bool = False,
+        compress: bool = False,
+        http2: bool = False,
+    ):
+        self.base_url = (
+            f"{management_url}/api/v2/search_engines/{hash_id}/indices/{index_name}"
+        )
+        self._temp_url = f"{self.base_url}/temp"
+        self._bulk_url = f"{self._temp_url if temp else self.base_url}/items/_bulk"
+        self.headers = {
+            "Authorization": f"Token {token}",
+            "Content-Type": "application/json",
+        }
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.compress = compress
+        self.http2 = http2
+        self._gzip_supported = False
+        self.concurrency = workers
+        self._in_flight = 0
+        self._window_requests = 0
+        self._window_throttled = 0
+        self._last_change = time.monotonic()
+        self._slots = None
+        self.session = None
+
+    async def __aenter__(self):
+        if self.http2:
+            self.session = httpx.AsyncClient(
+                http2=True,
+                headers=self.headers,
+                limits=httpx.Limits(
+                    max_connections=self.workers,
+                    max_keepalive_connections=self.workers,
+                ),
+                timeout=30,
+            )
+        else:
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=self.workers),
+                timeout=aiohttp.ClientTimeout(total=30),
+            )
+        self._slots = asyncio.Condition()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self.http2:
+            await self.session.aclose()
+        else:
+            await self.session.close()
+
+    async def _request(
+        self, method: str, url: str, data: Optional[bytes] = None, headers=None
+    ) -> Any:
+        """Send a request over the active client and decode its JSON body"""
+        if self.http2:
+            response = await self.session.request(
+                method, url, content=data, headers=headers
+            )
+            status, reason = response.status_code, response.reason_phrase
+            body = response.content
+        else:
+            async with self.session.request(
+                method, url, data=data, headers=headers
+            ) as response:
+                status, reason = response.status, response.reason
+                body = await response.read()
+
+        if status == 429:
+            self._record_response(throttled=True)
+        if status >= 400:
+            raise DoofinderAPIError(status, reason, response.headers)
+        try:
+            return orjson.loads(body) if body else None
+        except orjson.JSONDecodeError:
+            raise DoofinderAPIError(status, "invalid JSON body", response.headers)
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_retry_after,
+        retry=retry_if_exception(is_transient_error),
+        reraise=True,
+    )
+    async def _post_bulk(self, products: List[bytes]) -> Dict[str, Any]:
+        body = b"[" + b",".join(products) + b"]"
+        if not self.compress or len(body) <= COMPRESS_MIN_BYTES:
+            return await self._send_bulk(body)
+
+        try:
+            result = await self._send_bulk(
+                gzip.compress(body, compresslevel=1), {"Content-Encoding": "gzip"}
+            )
+        except DoofinderAPIError as e:
+            # Until a gzip body has been accepted, a 400/415 may just mean the
+            # endpoint cannot decode it: resend plain and stop compressing
+            if self._gzip_supported or e.status not in (400, 415):
+                raise
+            result = await self._send_bulk(body)
+            if self.compress:
+                self.compress = False
+                logger.warning("Doofinder rejected a gzip body, sending uncompressed")
+            return result
+        self._gzip_supported = True
+        return result
+
+    async def _send_bulk(self, body: bytes, headers=None) -> Dict[str, Any]:
+        async with self._slot():
+            result = await self._request("POST", self._bulk_url, body, headers)
+        self._record_response(throttled=False)
+        return result
+
+    @asynccontextmanager
+    async def _slot(self):
+        """Hold one of the `concurrency` request slots"""
+        async with self._slots:
+            await self._slots.wait_for(lambda: self._in_flight < self.concurrency)
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            async with self._slots:
+                self._in_flight -= 1
+                self._slots.notify_all()
+
+    def _record_response(self, throttled: bool):
+        """Adjust `concurrency` from the share of rate-limited responses"""
+        self._window_requests += 1
+        self._window_throttled += throttled
+        if self._window_requests < THROTTLE_WINDOW:
+            return
+
+        now = time.monotonic()
+        rate = self._window_throttled / self._window_requests
+        if rate > THROTTLE_RATE and self.concurrency > 1:
+            self.concurrency //= 2
+            self._last_change = now
+            logger.warning(
+                f"{rate:.0%} of requests rate limited, lowering concurrency to "
+                f"{self.concurrency}; consider a lower --workers"
+            )
+        elif rate > THROTTLE_RATE:
+            self._last_change = now
+        elif (
+            self.concurrency < self.workers
+            and now - self._last_change >= RECOVERY_SECONDS
+        ):
+            self.concurrency = min(self.concurrency * 2, self.workers)
+            self._last_change = now
+            logger.info(f"Raising concurrency to {self.concurrency}")
+        self._window_requests = 0
+        self._window_throttled = 0
+
+    async def create_temporary_index(self) -> Dict[str, Any]:
+        """Create an empty temporary copy of the index"""
+        return await self._request("POST", self._temp_url)
+
+    async def delete_temporary_index(self):
+        """Discard the temporary copy of the index"""
+        await self._request("DELETE", self._temp_url)
+
+    async def replace_index(self) -> Dict[str, Any]:
+        """Replace the live index with its temporary copy"""
+        return await self._request("POST", f"{self.base_url}/_replace_by_temp")
+
+    async def ingest_batch(self, products: List[bytes]) -> Dict[str, Any]:
+        """Bulk create a batch of already serialized products in the index"""
+        try:
+            return await self._post_bulk(products)
+        except (DoofinderAPIError, *TRANSPORT_ERRORS) as e:
+            return {
+                "error": str(e) or type(e).__name__,
+                "ids": [orjson.loads(product)["id"] for product in products],
+            }
+
+
+def transform_product(product: Dict[str, Any], fallback_id: str) -> Dict[str, Any]:
     """Transform product data to Doofinder format"""
     return {
-        "id": product.get("platform_id"),
+        "id": product.get("platform_id") or fallback_id,
         "title": product["title"],
         "description": product.get("description", ""),
         "image_url": product.get("image_url", ""),
@@ -37,47 +297,270 @@ def transform_product(product: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
-def batch(iterable, size=100):
-    """Yield successive batches of size from iterable"""
-    for i in range(0, len(iterable), size):
-        yield iterable[i : i + size]
+async def iter_products(products_file: str, run_id: str):
+    """Stream transformed, serialized products from a JSON array file"""
+    async with aiofiles.open(products_file, "rb") as f:
+        i = 0
+        async for product in ijson.items(f, "item", use_float=True):
+            yield orjson.dumps(transform_product(product, f"gen-{run_id}-{i}"))
+            i += 1
+
+
+async def iter_batches(products, size: int, max_bytes: int):
+    """Group serialized products into batches of at most `size` items and `max_bytes`"""
+    product_batch = []
+    batch_bytes = 2  # enclosing brackets
+    async for data in products:
+        if product_batch and batch_bytes + len(data) + 1 > max_bytes:
+            yield product_batch
+            product_batch = []
+            batch_bytes = 2
+        product_batch.append(data)
+        batch_bytes += len(data) + 1
+        if len(product_batch) == size:
+            yield product_batch
+            product_batch = []
+            batch_bytes = 2
+    if product_batch:
+        yield product_batch
 
 
-def push_data_to_doofinder(
-    hash_id: str, index_name: str, products: List[Dict[str, Any]]
+async def push_data_to_doofinder(
+    client: DoofinderIngestion,
+    products,
+    desc: str = "Uploading products to Doofinder",
+    leave: bool = True,
 ):
-    """Upload products in batches of 100"""
-    batches = list(batch(products, 100))
-    results = []
+    """Upload products in batches, keeping at most `2 * workers` batches in memory"""
+    semaphore = asyncio.Semaphore(client.workers * 2)
+    tasks = []
+
+    with tqdm(desc=desc, unit="batch", leave=leave) as pbar:
+
+        def on_done(_):
+            semaphore.release()
+            pbar.update(1)
+
+        try:
+            async for product_batch in iter_batches(
+                products, client.batch_size, client.max_batch_bytes
+            ):
+                await semaphore.acquire()
+                task = asyncio.create_task(client.ingest_batch(product_batch))
+                task.add_done_callback(on_done)
+                tasks.append(task)
+        except BaseException:
+            # Don't leave uploads running against a session about to close
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        return await asyncio.gather(*tasks)
 
-    for product_batch in tqdm(batches, desc="Uploading products to Doofinder"):
-        transformed_products = [transform_product(product) for product in product_batch]
-        result = pydoof.items.bulk_create(hash_id, index_name, transformed_products)
-        results.append(result)
 
-    return results
+async def iter_sample(sample: List[bytes]):
+    """Replay an in-memory sample as a product stream"""
+    for data in sample:
+        yield data
+
+
+async def measure_throughput(
+    client: DoofinderIngestion, sample: List[bytes]
+) -> Tuple[float, bool]:
+    """Median products per second over repeated uploads, and whether any failed"""
+    rates = []
+    had_failures = False
+    deadline = time.monotonic() + TUNE_SECONDS
+    while not rates or time.monotonic() < deadline:
+        start = time.monotonic()
+        results = await push_data_to_doofinder(
+            client,
+            iter_sample(sample),
+            desc=f"Tuning workers={client.workers} batch_size={client.batch_size}",
+            leave=False,
+        )
+        failed = sum(len(result["ids"]) for result in results if "error" in result)
+        rates.append((len(sample) - failed) / (time.monotonic() - start))
+        if failed:
+            had_failures = True
+            if failed == len(sample):
+                break
+    return statistics.median(rates), had_failures
+
+
+async def auto_tune(
+    doofinder_token: str,
+    doofinder_management_url: str,
+    doofinder_hash_id: str,
+    index_name: str,
+    products_file: str,
+    run_id: str,
+    workers: int,
+    batch_size: int,
+    max_batch_bytes: int,
+    temp: bool = False,
+    compress: bool = False,
+    http2: bool = False,
+) -> Tuple[int, int]:
+    """Pick the fastest (workers, batch_size) from TUNE_GRID, cached in TUNE_FILE"""
+    sample = []
+    async with aclosing(iter_products(products_file, run_id)) as products:
+        async for data in products:
+            sample.append(data)
+            if len(sample) == TUNE_SAMPLE_SIZE:
+                break
+    if not sample:
+        logger.warning("No products to calibrate with, skipping auto-tune")
+        return workers, batch_size
+
+    # Bucket the average size by powers of two so the key stays stable
+    avg_bytes = sum(map(len, sample)) // len(sample)
+    key = "|".join(
+        [
+            doofinder_management_url,
+            doofinder_hash_id,
+            str(avg_bytes.bit_length()),
+            str(max_batch_bytes),
+            "gzip" if compress else "identity",
+            "h2" if http2 else "h1",
+        ]
+    )
+    tuned = {}
+    if TUNE_FILE.exists():
+        tuned = await load_json(TUNE_FILE) or {}
+    if key in tuned:
+        workers, batch_size = tuned[key]
+        logger.info(f"Using cached tuning: workers={workers} batch_size={batch_size}")
+        return workers, batch_size
+
+    rates = {}
+    had_failures = False
+    for grid_workers, grid_batch_size in TUNE_GRID:
+        async with DoofinderIngestion(
+            doofinder_token,
+            doofinder_management_url,
+            doofinder_hash_id,
+            index_name,
+            workers=grid_workers,
+            batch_size=grid_batch_size,
+            max_batch_bytes=max_batch_bytes,
+            temp=temp,
+            compress=compress,
+            http2=http2,
+        ) as client:
+            rate, failed = await measure_throughput(client, sample)
+        rates[(grid_workers, grid_batch_size)] = rate
+        had_failures = had_failures or failed
+        logger.info(
+            f"workers={grid_workers} batch_size={grid_batch_size}: "
+            f"{rate:.1f} products/s{' (with failed uploads)' if failed else ''}"
+        )
+
+    best = max(rates, key=rates.get)
+    if rates[best] == 0:
+        logger.warning(
+            "Every calibration upload failed, keeping "
+            f"workers={workers} batch_size={batch_size}"
+        )
+        return workers, batch_size
+
+    workers, batch_size = best
+    if had_failures:
+        logger.warning("Some calibration uploads failed, not caching the result")
+    else:
+        tuned[key] = [workers, batch_size]
+        await save_json(TUNE_FILE, tuned)
+    logger.info(f"Selected workers={workers} batch_size={batch_size}")
+    return workers, batch_size
 
 
 async def main(
     doofinder_token: str,
-    doofinder_search_url: str,
     doofinder_management_url: str,
     doofinder_hash_id: str,
     index_name: str,
     products_file: str,
     output_file: str,
+    workers: int = 5,
+    batch_size: int = 100,
+    max_batch_bytes: int = 5 * 1024 * 1024,
+    tune: bool = False,
+    replace: bool = False,
+    compress: bool = False,
+    http2: bool = False,
 ):
-    pydoof.token = doofinder_token
-    pydoof.search_url = doofinder_search_url
-    pydoof.management_url = doofinder_management_url
+    run_id = f"{int(time.time())}-{uuid4().hex[:8]}"
 
-    products = await load_json(products_file)
+    # Creates, drops or swaps in the temporary index around the upload
+    async with DoofinderIngestion(
+        doofinder_token, doofinder_management_url, doofinder_hash_id, index_name
+    ) as manager:
+        if replace:
+            await manager.create_temporary_index()
 
-    results = await asyncio.to_thread(
-        push_data_to_doofinder, doofinder_hash_id, index_name, products
-    )
+        try:
+            if tune:
+                workers, batch_size = await auto_tune(
+                    doofinder_token,
+                    doofinder_management_url,
+                    doofinder_hash_id,
+                    index_name,
+                    products_file,
+                    run_id,
+                    workers,
+                    batch_size,
+                    max_batch_bytes,
+                    temp=replace,
+                    compress=compress,
+                    http2=http2,
+                )
+
+            async with DoofinderIngestion(
+                doofinder_token,
+                doofinder_management_url,
+                doofinder_hash_id,
+                index_name,
+                workers=workers,
+                batch_size=batch_size,
+                max_batch_bytes=max_batch_bytes,
+                temp=replace,
+                compress=compress,
+                http2=http2,
+            ) as client:
+                logger.info(f"Connection pool limited to {workers} connections")
+                results = await push_data_to_doofinder(
+                    client, iter_products(products_file, run_id)
+                )
+        except Exception:
+            if replace:
+                await manager.delete_temporary_index()
+            raise
 
-    await save_json(output_file, results)
+        success_count = sum(1 for result in results if "error" not in result)
+        error_count = sum(1 for result in results if "error" in result)
+
+        replace_task = None
+        if replace and (error_count or not success_count):
+            logger.error(
+                f"Only {success_count} of {len(results)} batches uploaded, "
+                "keeping the live index"
+            )
+            await manager.delete_temporary_index()
+        elif replace:
+            # Swap the index while the summary and results are written out
+            replace_task = asyncio.create_task(manager.replace_index())
+
+        logger.info("Upload Summary")
+        logger.info(f"Total batches: {len(results)}")
+        logger.info(f"Successfully uploaded: {success_count}")
+        logger.info(f"Failed to upload: {error_count}")
+
+        await save_json(output_file, results)
+
+        if replace_task:
+            await replace_task
+            logger.info(f"Replaced {index_name} with the uploaded products")
 
 
 if __name__ == "__main__":
@@ -96,19 +579,62 @@ if __name__ == "__main__":
         default="results.json",
         help="Path to save results (default: results.json)",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=5,
+        help="Number of concurrent upload requests (default: 5)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help="Maximum products per upload request (default: 100)",
+    )
+    parser.add_argument(
+        "--max-batch-bytes",
+        type=int,
+        default=5 * 1024 * 1024,
+        help="Maximum request body size in bytes (default: 5242880)",
+    )
+    parser.add_argument(
+        "--auto-tune",
+        action="store_true",
+        help="Calibrate --workers and --batch-size on a sample before uploading",
+    )
+    parser.add_argument(
+        "--replace",
+        action="store_true",
+        help="Upload into a temporary index and swap it for the live one at the end",
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Gzip upload bodies larger than 16 KiB",
+    )
+    parser.add_argument(
+        "--http2",
+        action="store_true",
+        help="Multiplex uploads over HTTP/2 (pair with a higher --workers)",
+    )
 
     args = parser.parse_args()
 
-    search_url = f"https://{args.region}-search.doofinder.com"
     management_url = f"https://{args.region}-api.doofinder.com"
     asyncio.run(
         main(
             doofinder_token=args.token,
-            doofinder_search_url=search_url,
             doofinder_management_url=management_url,
             doofinder_hash_id=args.hash_id,
             index_name=args.index_name,
             products_file=args.products_file,
             output_file=args.output_file,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            max_batch_bytes=args.max_batch_bytes,
+            tune=args.auto_tune,
+            replace=args.replace,
+            compress=args.compress,
+            http2=args.http2,
         )
     )
@@ -14,10 +14,14 @@ Usage:
 
 import argparse
 import asyncio
-from typing import Dict, List
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import uuid4
 
-import pydoof
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 
 from src.utils import load_json, save_json
 from src.logger import get_logger
@@ -25,25 +29,92 @@ from src.logger import get_logger
 logger = get_logger(__name__)
 
 
+def flatten_params(key: str, value: Any, out: List[Tuple[str, Any]]):
+    """Append `value` to `out` as Doofinder query-string pairs like `filter[brand][]`"""
+    if isinstance(value, dict):
+        for field, item in value.items():
+            flatten_params(f"{key}[{field}]", item, out)
+    elif isinstance(value, (list, tuple)):
+        if any(isinstance(item, dict) for item in value):
+            for i, item in enumerate(value):
+                flatten_params(f"{key}[{i}]", item, out)
+        else:
+            out.extend((f"{key}[]", item) for item in value)
+    elif isinstance(value, bool):
+        out.append((key, str(value).lower()))
+    elif value is not None:
+        out.append((key, value))
+
+
+class DoofinderSearch:
+    """
+    Doofinder Search API client sending every query with one `session_id`.
+
+    Pass `session_id=` or reassign `client.session_id` (≤32 chars) per end user.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        search_url: str,
+        hash_id: str,
+        session_id: Optional[str] = None,
+    ):
+        self.base_url = f"{search_url}/6/{hash_id}"
+        self._search_url = f"{self.base_url}/_search"
+        self.session_id = session_id or uuid4().hex
+        self.headers = {"Authorization": f"Token {token}"}
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=[429, 502, 503, 504],
+            ),
+        )
+        self.session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def search(
+        self,
+        query: str,
+        rpp: int = 25,
+        filters: Optional[Dict[str, Any]] = None,
+        sort: Optional[List[Dict[str, str]]] = None,
+    ) -> Dict:
+        """Run a search query against the search engine"""
+        params = [("query", query), ("rpp", rpp), ("session_id", self.session_id)]
+        flatten_params("filter", filters, params)
+        flatten_params("sort", sort, params)
+        response = self.session.get(self._search_url, params=params, timeout=30)
+        response.raise_for_status()
+        return orjson.loads(response.content)
+
+
 def get_product_ids(response):
     """Extract product IDs from Doofinder search response"""
     try:
         products = response["results"]
         return [product["id"] for product in products]
     except KeyError:
-        logger.error(f"Error in response format: {response.json()}")
+        logger.error(f"Error in response format: {response}")
         return []
 
 
-def search_doofinder(hash_id: str, queries: List[Dict], count: int = 25):
+def search_doofinder(client: DoofinderSearch, queries: List[Dict], count: int = 25):
     """Run benchmark search queries against Doofinder index"""
     results = []
     for query in tqdm(queries, desc="Running search queries"):
-        response = pydoof.search.query(
-            hashid=hash_id,
-            query=query["query"],
-            rpp=count,
-        )
+        response = client.search(query["query"], rpp=count)
         results.append(
             {
                 "query_id": query["query_id"],
@@ -64,15 +135,13 @@ async def main(
 ):
     """Main function to run Doofinder benchmark"""
     logger.info(f"Loading queries from {queries_file}...")
-    pydoof.token = doofinder_token
-    pydoof.search_url = doofinder_search_url
-
     queries = await load_json(queries_file)
     logger.info(f"Running {len(queries)} search queries against Doofinder...")
 
-    results = await asyncio.to_thread(
-        search_doofinder, doofinder_hash_id, queries, count
-    )
+    with DoofinderSearch(
+        doofinder_token, doofinder_search_url, doofinder_hash_id
+    ) as client:
+        results = await asyncio.to_thread(search_doofinder, client, queries, count)
 
     logger.info(f"Saving results to {output_file}...")
     await save_json(output_file, results)
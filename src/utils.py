@@ -1,14 +1,15 @@
 import json
 
 import aiofiles
+import orjson
 
 
 async def load_json(file_path: str):
-    async with aiofiles.open(file_path, "r") as f:
+    async with aiofiles.open(file_path, "rb") as f:
         try:
             data = await f.read()
-            return json.loads(data)
-        except json.JSONDecodeError:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
             return None
 
 